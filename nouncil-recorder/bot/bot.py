@@ -17,29 +17,33 @@ Automatic Features:
 import discord
 from discord.ext import commands
 import asyncio
-import wave
+import functools
+import queue
+import threading
 import pyaudio
+import numpy as np
+import soundfile as sf
 import logging
 from datetime import datetime
 import os
 from config.config import *
 
-# Set up logging
+# Handlers are configured once on the root logger by main.setup_logging
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
 
-# Create handlers
-console_handler = logging.StreamHandler()
-file_handler = logging.FileHandler(os.path.join(LOGS_DIR, 'bot.log'))
-
-# Create formatters and add it to handlers
-log_format = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-console_handler.setFormatter(log_format)
-file_handler.setFormatter(log_format)
-
-# Add handlers to the logger
-logger.addHandler(console_handler)
-logger.addHandler(file_handler)
+# Write buffer for recordings, so the disk sees ~1 write per MiB of audio
+RECORDING_BUFFER_SIZE = 1 << 20
+# Seconds of audio gathered in memory before each write to the FLAC encoder
+RECORDING_BLOCK_SECONDS = 5
+# Scratch blocks preallocated so the stream callback never waits on the writer
+RECORDING_BLOCK_COUNT = 3
+# PyAudio sample format, soundfile buffer dtype and FLAC subtype for each
+# FORMAT config value that can be recorded to FLAC
+SAMPLE_FORMATS = {
+    'int16': (pyaudio.paInt16, 'int16', 'PCM_16'),
+    'int32': (pyaudio.paInt32, 'int32', 'PCM_24'),
+    'float32': (pyaudio.paFloat32, 'float32', 'PCM_24'),
+}
 
 class AutoRecordBot(commands.Bot):
     def __init__(self):
@@ -51,9 +55,43 @@ class AutoRecordBot(commands.Bot):
         self.recording = False
         self.voice_client = None
         self.current_recording_channel = None
-        self.frames = []
         self.audio = None
         self.stream = None
+        self.sound_file = None
+        self.recording_file = None
+        self.recording_path = None
+        self.frames_captured = 0  # frames copied from the stream, not necessarily on disk
+        self._write_failed = False
+        self._nonbot_counts = {}  # voice channel id -> non-bot member count
+        self._stop_event = asyncio.Event()
+        # Serializes start/stop, voice state events can arrive in bursts
+        self._state_lock = asyncio.Lock()
+        
+        # Sample format is fixed by config, resolve it once
+        if FORMAT.lower() not in SAMPLE_FORMATS:
+            raise ValueError(f"Sample format {FORMAT!r} can't be recorded to FLAC, "
+                             f"use one of {', '.join(SAMPLE_FORMATS)}")
+        self._pa_format, self._sf_dtype, self._flac_subtype = SAMPLE_FORMATS[FORMAT.lower()]
+        self._sample_width = pyaudio.get_sample_size(self._pa_format)
+        
+        # Reusable scratch blocks: the callback fills one while the writer thread
+        # encodes the ones queued in _filled_blocks and hands them back
+        block_size = RATE * CHANNELS * self._sample_width * RECORDING_BLOCK_SECONDS
+        self._free_blocks = queue.Queue()
+        for _ in range(RECORDING_BLOCK_COUNT):
+            self._free_blocks.put(bytearray(block_size))
+        self._filled_blocks = queue.Queue()
+        self._scratch = None
+        self._scratch_used = 0
+        self._overflows = 0
+        self._writer = None
+        
+        # Input levels are measured as a fraction of full scale
+        self._np_dtype = np.dtype(self._sf_dtype)
+        if np.issubdtype(self._np_dtype, np.integer):
+            self._full_scale = float(np.iinfo(self._np_dtype).max)
+        else:
+            self._full_scale = 1.0
         
         # Add commands
         self.add_command(commands.Command(self.stop, name='stop'))
@@ -63,26 +101,50 @@ class AutoRecordBot(commands.Bot):
         logger.info("Bot is setting up...")
         os.makedirs(RECORDINGS_DIR, exist_ok=True)
         os.makedirs(LOGS_DIR, exist_ok=True)
+        # PortAudio init enumerates every device, so do it once for the bot's lifetime
+        self.audio = await self.loop.run_in_executor(None, pyaudio.PyAudio)
 
     async def on_ready(self):
         logger.info(f'Bot is ready! Logged in as {self.user}')
-        # Start monitoring all voice channels
-        for guild in self.guilds:
-            for vc in guild.voice_channels:
-                await self.check_channel(vc)
+        # Seed counts for occupied voice channels, empty ones are counted on first join
+        occupied = [vc for guild in self.guilds for vc in guild.voice_channels if vc.members]
+        self._nonbot_counts = {vc.id: self._count_members(vc) for vc in occupied}
+        await asyncio.gather(*(self.check_channel(vc, self._nonbot_counts[vc.id]) for vc in occupied))
 
     async def on_voice_state_update(self, member, before, after):
         """Triggered when someone joins/leaves a voice channel"""
-        # Check channels that were affected by the change
-        if before and before.channel:
-            await self.check_channel(before.channel)
-        if after and after.channel:
-            await self.check_channel(after.channel)
-
-    async def check_channel(self, channel):
-        """Check if a channel should be recorded based on member count"""
-        member_count = len([m for m in channel.members if not m.bot])
+        # Bots never count towards the threshold, and mute/deafen/video
+        # toggles don't change who is in which channel
+        if member.bot or before.channel == after.channel:
+            return
         
+        # Check channels that were affected by the change
+        if before.channel:
+            await self.check_channel(before.channel, self._update_count(before.channel, -1))
+        if after.channel:
+            await self.check_channel(after.channel, self._update_count(after.channel, 1))
+
+    def _count_members(self, channel):
+        """Count the non-bot members currently in a channel"""
+        return sum(1 for m in channel.members if not m.bot)
+
+    def _update_count(self, channel, delta):
+        """Apply a join/leave delta to the cached non-bot count of a channel"""
+        member_count = self._nonbot_counts.get(channel.id)
+        if member_count is None:
+            # Not seen since startup; channel.members already reflects this update
+            member_count = self._count_members(channel)
+        else:
+            member_count = max(member_count + delta, 0)
+        self._nonbot_counts[channel.id] = member_count
+        return member_count
+
+    def _has_quorum(self, channel):
+        """Whether the cached count says a channel should currently be recorded"""
+        return self._nonbot_counts.get(channel.id, 0) >= 3
+
+    async def check_channel(self, channel, member_count):
+        """Check if a channel should be recorded based on its non-bot member count"""
         if member_count >= 3 and not self.recording:
             # Start recording if not already recording
             await self.start_recording(channel)
@@ -92,103 +154,237 @@ class AutoRecordBot(commands.Bot):
 
     async def start_recording(self, channel):
         """Start recording a voice channel"""
-        if self.recording:
-            return
-        
-        try:
-            self.voice_client = await channel.connect()
-            self.current_recording_channel = channel
-            
-            self.audio = pyaudio.PyAudio()
-            self.stream = self.audio.open(
-                format=getattr(pyaudio, 'pa' + FORMAT.upper()),
-                channels=CHANNELS,
-                rate=RATE,
-                input=True,
-                frames_per_buffer=CHUNK
-            )
-            
-            self.recording = True
-            self.frames = []
+        async with self._state_lock:
+            # Members may have left while we waited for the lock
+            if self.recording or not self._has_quorum(channel):
+                return
             
-            # Announce start of recording
-            await self.announce_recording_start(channel)
-            
-            # Start recording loop
-            asyncio.create_task(self.record_loop())
-            
-            logger.info(f"Started recording in channel: {channel.name}")
-        except Exception as e:
-            logger.error(f"Error starting recording: {e}")
-            await self.cleanup_recording()
+            try:
+                self.voice_client = await channel.connect()
+                self.current_recording_channel = channel
+                
+                if not self._has_quorum(channel):
+                    logger.info(f"Not recording {channel.name}, members left while connecting")
+                    await self.cleanup_recording()
+                    return
+                
+                self._stop_event.clear()
+                
+                # Open the output file up front so frames are streamed to disk
+                self.recording_path = self._new_recording_path()
+                # libsndfile seeks back to patch the stream info on close, so open read/write
+                self.recording_file = open(self.recording_path, 'w+b', buffering=RECORDING_BUFFER_SIZE)
+                self.sound_file = sf.SoundFile(
+                    self.recording_file, 'w',
+                    samplerate=RATE,
+                    channels=CHANNELS,
+                    format='FLAC',
+                    subtype=self._flac_subtype
+                )
+                self.frames_captured = 0
+                self._write_failed = False
+                self._overflows = 0
+                
+                # Encoding happens on a writer thread, the callback only copies audio
+                self._scratch = self._free_blocks.get()
+                self._scratch_used = 0
+                self._writer = threading.Thread(target=self._write_blocks, name='recording-writer', daemon=True)
+                self._writer.start()
+                
+                # Opening the device blocks, keep it off the event loop
+                self.stream = await self.loop.run_in_executor(None, functools.partial(
+                    self.audio.open,
+                    format=self._pa_format,
+                    channels=CHANNELS,
+                    rate=RATE,
+                    input=True,
+                    frames_per_buffer=CHUNK,
+                    stream_callback=self._pa_callback
+                ))
+                
+                self.recording = True
+                
+                # Announce start of recording
+                await self.announce_recording_start(channel)
+                
+                # Stop the recording if the stream or writer fails, without polling
+                asyncio.create_task(self._watch_stream())
+                
+                logger.info(f"Started recording in channel: {channel.name}")
+            except Exception as e:
+                logger.error(f"Error starting recording: {e}")
+                await self.cleanup_recording()
+        
+        # A drop below the threshold during startup was ignored by check_channel
+        # since we weren't recording yet, so catch it now that the lock is free
+        if self.recording and self.current_recording_channel == channel and not self._has_quorum(channel):
+            await self.stop_recording(auto_stopped=True)
 
-    async def record_loop(self):
-        """Main recording loop"""
+    def _new_recording_path(self):
+        """Name a recording after its start time without overwriting an earlier one"""
+        stem = f'nouncil_recording_{datetime.now().strftime("%Y%m%d_%H%M%S")}'
+        path = os.path.join(RECORDINGS_DIR, f'{stem}.flac')
+        suffix = 1
+        # A recording can stop and restart within the same second
+        while os.path.exists(path):
+            path = os.path.join(RECORDINGS_DIR, f'{stem}_{suffix}.flac')
+            suffix += 1
+        return path
+
+    def _pa_callback(self, in_data, frame_count, time_info, status):
+        """PyAudio stream callback, runs on PortAudio's thread so it only copies audio"""
+        if status & pyaudio.paInputOverflow:
+            # Reported by the writer thread, logging here could block the audio thread
+            self._overflows += 1
         try:
-            while self.recording:
-                data = self.stream.read(CHUNK)
-                self.frames.append(data)
-                await asyncio.sleep(0.01)
+            size = len(in_data)
+            if self._scratch_used + size > len(self._scratch):
+                self._hand_off_scratch()
+            self._scratch[self._scratch_used:self._scratch_used + size] = in_data
+            self._scratch_used += size
+            self.frames_captured += frame_count
         except Exception as e:
-            logger.error(f"Error in recording loop: {e}")
+            logger.error(f"Error in recording callback: {e}")
+            self.loop.call_soon_threadsafe(self._stop_event.set)
+            return (None, pyaudio.paAbort)
+        return (None, pyaudio.paContinue)
+
+    async def _watch_stream(self):
+        """Wait for the recording to end, stopping it if the stream or writer failed"""
+        await self._stop_event.wait()
+        if self.recording:
             await self.stop_recording(error=True)
 
     async def stop_recording(self, auto_stopped=False, error=False):
         """Stop the current recording"""
-        if not self.recording:
-            return
-            
-        self.recording = False
-        channel = self.current_recording_channel
-        
-        try:
-            # Save the recording if we have any frames
-            if self.frames:
-                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                filename = f'nouncil_recording_{timestamp}'
-                wav_path = os.path.join(RECORDINGS_DIR, f'{filename}.wav')
-                
-                with wave.open(wav_path, 'wb') as wf:
-                    wf.setnchannels(CHANNELS)
-                    wf.setsampwidth(self.audio.get_sample_size(
-                        getattr(pyaudio, 'pa' + FORMAT.upper())))
-                    wf.setframerate(RATE)
-                    wf.writeframes(b''.join(self.frames))
+        async with self._state_lock:
+            if not self.recording:
+                return
                 
-                logger.info(f"Saved recording to {wav_path}")
+            self.recording = False
+            self._stop_event.set()
+            channel = self.current_recording_channel
+            
+            try:
+                # Stop the stream before finalizing so no callback writes after close
+                await self.loop.run_in_executor(None, self.stream.stop_stream)
+                # Encoding the last block and finalizing the file can take a while
+                await self.loop.run_in_executor(None, self.close_recording_file)
                 
-                if auto_stopped:
-                    await channel.send("Recording stopped - less than 3 members in channel")
-                elif error:
-                    await channel.send("Recording stopped due to an error")
-                else:
-                    await channel.send("Recording stopped manually")
+                if self._write_failed:
+                    # Whatever reached the file is kept, but it is truncated
+                    logger.error(f"Recording {self.recording_path} is incomplete, writing it failed")
+                    await channel.send("Error saving recording")
+                # Keep the recording only if we captured any frames
+                elif self.frames_captured:
+                    filename = os.path.splitext(os.path.basename(self.recording_path))[0]
+                    logger.info(f"Saved recording to {self.recording_path}")
                     
-                await channel.send(f"Recording saved as: {filename}")
-        except Exception as e:
-            logger.error(f"Error saving recording: {e}")
-            if channel:
-                await channel.send("Error saving recording")
-        finally:
-            await self.cleanup_recording()
+                    if auto_stopped:
+                        await channel.send("Recording stopped - less than 3 members in channel")
+                    elif error:
+                        await channel.send("Recording stopped due to an error")
+                    else:
+                        await channel.send("Recording stopped manually")
+                        
+                    await channel.send(f"Recording saved as: {filename}")
+            except Exception as e:
+                logger.error(f"Error saving recording: {e}")
+                if channel:
+                    await channel.send("Error saving recording")
+            finally:
+                await self.cleanup_recording()
 
     async def cleanup_recording(self):
         """Cleanup recording resources"""
         if self.stream:
-            self.stream.stop_stream()
-            self.stream.close()
-        if self.audio:
-            self.audio.terminate()
+            await self.loop.run_in_executor(None, self.stream.stop_stream)
+            await self.loop.run_in_executor(None, self.stream.close)
+        if self.recording_file:
+            await self.loop.run_in_executor(None, self.close_recording_file)
+        # Don't leave empty files behind, e.g. when the input device failed to open
+        if self.recording_path and not self.frames_captured and os.path.exists(self.recording_path):
+            os.remove(self.recording_path)
         if self.voice_client:
             await self.voice_client.disconnect()
             
         self.stream = None
-        self.audio = None
         self.voice_client = None
         self.current_recording_channel = None
-        self.frames = []
+        self.recording_path = None
+        self.frames_captured = 0
         self.recording = False
 
+    def _hand_off_scratch(self):
+        """Queue the filled scratch block for the writer thread and take a free one"""
+        self._filled_blocks.put((self._scratch, self._scratch_used))
+        try:
+            self._scratch = self._free_blocks.get_nowait()
+        except queue.Empty:
+            # The writer has fallen behind, grow the pool rather than block the audio thread
+            self._scratch = bytearray(len(self._scratch))
+        self._scratch_used = 0
+
+    def _write_blocks(self):
+        """Writer thread, encodes queued scratch blocks to the FLAC file in order"""
+        reported_overflows = 0
+        while True:
+            item = self._filled_blocks.get()
+            
+            overflows = self._overflows
+            if overflows > reported_overflows:
+                logger.warning(f"Audio input overflowed {overflows - reported_overflows} time(s), some audio was dropped")
+                reported_overflows = overflows
+            
+            if item is None:
+                return
+            block, used = item
+            if not self._write_failed:
+                try:
+                    self._encode_block(memoryview(block)[:used])
+                except Exception as e:
+                    logger.error(f"Error writing recording: {e}")
+                    self._write_failed = True
+                    self.loop.call_soon_threadsafe(self._stop_event.set)
+            self._free_blocks.put(block)
+
+    def _encode_block(self, block):
+        """Encode one block of audio to the FLAC file"""
+        self.sound_file.buffer_write(block, dtype=self._sf_dtype)
+        # Measuring levels copies the block, so only do it when debugging
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Encoded %d bytes, input levels %s", len(block), self._measure_levels(block))
+
+    def _measure_levels(self, block):
+        """Return per-channel mean levels of a block of audio"""
+        # One row per frame, one column per channel
+        samples = np.frombuffer(block, dtype=self._np_dtype).reshape(-1, CHANNELS)
+        return np.abs(samples, dtype=np.float32).mean(axis=0) / self._full_scale
+
+    def close_recording_file(self):
+        """Drain the writer thread, finalize the FLAC stream and flush the file to disk"""
+        # soundfile never closes file objects it was given, so close ours explicitly
+        try:
+            # The stream is stopped by now, so the callback no longer touches the scratch block
+            if self._scratch is not None:
+                if self._scratch_used:
+                    self._filled_blocks.put((self._scratch, self._scratch_used))
+                else:
+                    self._free_blocks.put(self._scratch)
+                self._scratch = None
+                self._scratch_used = 0
+            if self._writer:
+                self._filled_blocks.put(None)
+                self._writer.join()
+                self._writer = None
+            if self.sound_file:
+                self.sound_file.close()
+        finally:
+            if self.recording_file:
+                self.recording_file.close()
+            self.sound_file = None
+            self.recording_file = None
+
     async def announce_recording_start(self, channel):
         """Announce that recording is starting"""
         try:
@@ -220,7 +416,13 @@ class AutoRecordBot(commands.Bot):
         else:
             await ctx.send("Only administrators can force stop recordings")
 
-    def cog_unload(self):
-        """Cleanup when bot is shut down"""
-        if self.recording:
-            asyncio.create_task(self.stop_recording())
\ No newline at end of file
+    async def close(self):
+        """Finish any recording and release PortAudio when the bot shuts down"""
+        try:
+            # Must run before the connection closes so the file is finalized cleanly
+            await self.stop_recording()
+        finally:
+            await super().close()
+            if self.audio:
+                await self.loop.run_in_executor(None, self.audio.terminate)
+                self.audio = None
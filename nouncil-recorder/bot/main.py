@@ -25,7 +25,9 @@ async def main():
         
         # Initialize and start the bot
         bot = AutoRecordBot()
-        await bot.start(DISCORD_TOKEN)
+        # The context manager awaits bot.close() on exit, which saves any active recording
+        async with bot:
+            await bot.start(DISCORD_TOKEN)
     except Exception as e:
         logging.error(f"Failed to start bot: {e}")
         raise  # Re-raise the exception after logging